@@ -1,4 +1,4 @@
-from flask import Flask, request, send_file, jsonify, render_template, after_this_request
+from flask import Flask, request, send_file, jsonify, render_template
 import fitz
 from reportlab.pdfgen import canvas
 from reportlab.platypus import Table, TableStyle
@@ -7,23 +7,276 @@ from reportlab.lib.units import cm
 from reportlab.graphics.barcode import code128
 from reportlab.lib.utils import ImageReader
 import io
-from PIL import Image
+import logging
 import re
+import numpy as np
 import time
 import os
+import shutil
 import traceback
-import atexit
 import tempfile
+import textwrap
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from flask_cors import CORS
 
 HTML_TEMPLATE = """
 
 """
 
+# Logs por página/linha dominam os loops quentes (cada print formata string,
+# pega lock e dá flush). O detalhamento fica em nível DEBUG — ligado via
+# PRECLEAN_DEBUG=1 — e a formatação lazy do logging não custa nada desligada.
+DEBUG = os.environ.get("PRECLEAN_DEBUG") == "1"
+logger = logging.getLogger(__name__)
+
+# ==============================
+# Regexes pré-compiladas (evita recompilar a cada página/item)
+# ==============================
+_WS_RE = re.compile(r"\s+")
+_PROD_CODE_RE = re.compile(r'i\d{2}[a-z0-9]{6,10}')
+
+# Remoção de caracteres especiais por tabela de tradução (loop em C puro,
+# sem acionar o motor de regex para 4 codepoints fixos)
+_STRIP_TBL = str.maketrans('', '', '■□▪▫')
+
+# Registro de item na listagem da DANFE: linha de código (alfanumérica com ao
+# menos um dígito, para não confundir com palavras da descrição), linhas de
+# descrição e bloco "QUANT." opcional com a quantidade na linha seguinte
+_ITEM_HEADER_LINES = frozenset(["CONTEÚDO", "ATRIBUTOS", "QUANT.", "DESCRIÇÃO", "CÓDIGO"])
+_ITEM_RECORD_RE = re.compile(
+    r'^(?P<cod>(?=[A-Za-z]*\d)[A-Za-z0-9]{5,})[ \t]*$\n'
+    r'(?P<desc>(?:^(?!QUANT\.?[ \t]*$)(?!(?=[A-Za-z]*\d)[A-Za-z0-9]{5,}[ \t]*$).+$\n?)*)'
+    r'(?:^QUANT\.?[ \t]*$\n(?P<qtd>^\d+)[ \t]*$\n?)?',
+    re.MULTILINE
+)
+
+# Cabeçalhos que indicam etiqueta/DANFE legítima. "danfe" é de longe o mais
+# comum e é testado primeiro com um `in` direto; os demais entram em uma
+# alternação compilada, varrendo o texto uma única vez
+KEEP_HEADERS = (
+    "danfe", "fim do danfe", "chave de acesso",
+    "destinatário", "remetente", "pedido criado", "pieces", "peso",
+    "item", "conteúdo", "atributos", "quant"
+)
+_KEEP_HEADERS_REST_RE = re.compile(
+    "|".join(re.escape(h) for h in KEEP_HEADERS if "danfe" not in h)
+)
+
+# Dicionário de correções comuns para palavras cortadas nas descrições.
+# Os padrões viram uma única alternação: uma passada do regex pelo texto
+# resolve todas as correções, em vez de 15 re.sub sequenciais
+_CORRECOES = {
+    r'\bU\s+nissex\b': 'Unissex',
+    r'\bSkat\s+ista\b': 'Skatista',
+    r'\bMa\s+sculino\b': 'Masculino',
+    r'\bFe\s+minino\b': 'Feminino',
+    r'\bPre\s+mium\b': 'Premium',
+    r'\bCas\s+ual\b': 'Casual',
+    r'\bCam\s+pus\b': 'Campus',
+    r'\bTê\s+nis\b': 'Tênis',
+    r'\bSka\s+te\b': 'Skate',
+    r'\bCon\s+fortável\b': 'Confortável',
+    r'\bLan\s+çamento\b': 'Lançamento',
+    r'\bDia\s+a\s+Dia\b': 'Dia a Dia',
+    r'\bSu\s+per\b': 'Super',
+    r'\bLi\s+nha\b': 'Linha',
+    r'\bMo\s+retto\b': 'Moretto'
+}
+_CORRECOES_REPLS = list(_CORRECOES.values())
+_CORRECOES_RE = re.compile(
+    "|".join(f"({padrao})" for padrao in _CORRECOES), re.IGNORECASE
+)
+
+# Função para corrigir palavras cortadas
+def corrigir_palavras_cortadas(texto):
+    return _CORRECOES_RE.sub(lambda m: _CORRECOES_REPLS[m.lastindex - 1], texto)
+
+# Função para quebrar texto sem cortar palavras; textwrap faz a mesma quebra
+# por palavras no stdlib, sem a concatenação quadrática de strings. O
+# TextWrapper é montado uma vez (textwrap.wrap criaria um novo por chamada,
+# recompilando os regexes internos de quebra a cada item)
+_WRAPPER = textwrap.TextWrapper(
+    width=112, break_long_words=True, break_on_hyphens=False
+)
+
+def quebrar_texto_inteligente(texto, largura_maxima=112):
+    if largura_maxima != _WRAPPER.width:
+        _WRAPPER.width = largura_maxima
+    return "\n".join(_WRAPPER.wrap(texto))
+
+# Cache de quebra por conteúdo: lotes repetem as mesmas descrições de produto
+# (mesmos SKUs), então quebras repetidas viram hit de dicionário. O limite com
+# descarte do mais antigo evita crescer sem teto em um servidor de vida longa.
+_WRAP_CACHE = OrderedDict()
+_WRAP_CACHE_MAX = 4096
+
+def _quebrar_texto_cacheado(texto, largura_maxima=112):
+    key = (texto, largura_maxima)
+    quebrado = _WRAP_CACHE.get(key)
+    if quebrado is None:
+        quebrado = quebrar_texto_inteligente(texto, largura_maxima)
+        _WRAP_CACHE[key] = quebrado
+        if len(_WRAP_CACHE) > _WRAP_CACHE_MAX:
+            _WRAP_CACHE.popitem(last=False)
+    return quebrado
+
+# ==============================
+# Layout do PDF gerado (constantes — a página de saída é fixa em 799×1197 pt,
+# então estilo e larguras de coluna não variam por DANFE)
+# ==============================
+_PAGE_SIZE = (799, 1197)
+_TABLE_WIDTH = _PAGE_SIZE[0] * 0.98
+_COL_WIDTHS = [_TABLE_WIDTH * 0.85, _TABLE_WIDTH * 0.15]  # Melhor distribuição: 85% descrição, 15% quantidade
+
+_DANFE_STYLE_BASE = [
+    ('BACKGROUND', (0, 0), (-1, -1), colors.white),
+    ('TEXTCOLOR', (0, 0), (-1, -1), colors.black),
+    ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+    ('ALIGN', (1, 0), (1, -1), 'CENTER'),  # Centralizar quantidade
+    ('FONTNAME', (0, 0), (-1, -1), 'Helvetica-Bold'),
+    ('FONTSIZE', (0, 0), (-1, -1), 12),  # Fonte 12pt para máximo aproveitamento
+    ('BOTTOMPADDING', (0, 0), (-1, -1), 2),  # Padding mínimo inferior (2pt)
+    ('TOPPADDING', (0, 0), (-1, -1), 2),    # Padding mínimo superior (2pt)
+    ('LEFTPADDING', (0, 0), (-1, -1), 3),   # Padding mínimo esquerdo (3pt)
+    ('RIGHTPADDING', (0, 0), (-1, -1), 3),  # Padding mínimo direito (3pt)
+    ('GRID', (0, 0), (-1, -1), 0.5, colors.black),
+    ('LEADING', (0, 0), (-1, -1), 14)  # Espaçamento mínimo entre linhas (14pt)
+]
+
+# Dois estilos pré-montados: tabelas curtas (até 4 linhas) dispensam
+# NOSPLIT/ROWHEIGHT — as restrições só forçam uma passada extra de layout —
+# enquanto as longas, que vão para página própria, as mantêm. O WORDWRAP foi
+# removido: o texto já chega pré-quebrado (\n) de quebrar_texto_inteligente.
+_DANFE_STYLE_SMALL = TableStyle(_DANFE_STYLE_BASE)
+_DANFE_STYLE_LARGE = TableStyle(_DANFE_STYLE_BASE + [
+    ('NOSPLIT', (0, 0), (-1, -1)),
+    ('ROWHEIGHT', (0, 0), (-1, -1), 100),
+])
+
 # ==============================
 # PRE-CLEAN: remove páginas-sobra
 # ==============================
-def preclean_pdf_remove_overflow_by_blocks(input_pdf_path: str) -> str:
+def _norm_text(s: str) -> str:
+    # str.split() já colapsa qualquer whitespace (inclusive \xa0) em C,
+    # sem o custo da máquina de estados do regex
+    return " ".join((s or "").split()).lower()
+
+def _preclean_analyze_page(page):
+    """
+    Analisa uma única página e devolve as métricas independentes de ordem:
+
+      (text_norm, skip, is_small_fragment, is_scattered_fragment,
+       is_product_fragment, density, y_spread)
+
+    `skip=True` significa "manter incondicionalmente" (cabeçalho de DANFE ou
+    página sem blocos de texto). A similaridade com a página anterior depende
+    da ordem e é calculada depois, em um passo sequencial.
+    """
+    W, H = page.rect.width, page.rect.height
+
+    # Uma única extração por página: o texto é derivado dos próprios blocos,
+    # evitando rodar o layout do MuPDF duas vezes (get_text("text") + "blocks").
+    # A mesma varredura já acumula as coordenadas dos blocos com texto real,
+    # para não percorrer blocks_raw uma segunda vez.
+    blocks_raw = page.get_text("blocks") or []
+    parts = []
+    flat_coords = []
+    for b in blocks_raw:
+        if len(b) >= 5 and isinstance(b[4], str):
+            parts.append(b[4])
+            if b[4].strip():
+                flat_coords.extend(b[:4])
+    text_norm = _norm_text(" ".join(parts))
+
+    # Se parecer claramente uma etiqueta/DANFE com cabeçalho, mantém
+    # (sem pagar nada da geometria abaixo)
+    if "danfe" in text_norm or _KEEP_HEADERS_REST_RE.search(text_norm) is not None:
+        return (text_norm, True, False, False, False, 0.0, 0.0)
+
+    total_area = W * H
+
+    # Geometria vetorizada: coordenadas em um array N×4, áreas/métricas de
+    # uma vez em C (NumPy)
+    coords = np.array(flat_coords, dtype=np.float64).reshape(-1, 4)
+
+    area_text = 0.0
+    if coords.shape[0]:
+        bw = np.maximum(0.0, coords[:, 2] - coords[:, 0])
+        bh = np.maximum(0.0, coords[:, 3] - coords[:, 1])
+        area = bw * bh
+        # Descarta ruídos muito pequenos
+        mask = area >= 0.0003 * total_area
+        coords = coords[mask]
+        area_text = float(area[mask].sum())
+
+    if not coords.shape[0]:
+        return (text_norm, True, False, False, False, 0.0, 0.0)
+
+    num_blocks = coords.shape[0]
+
+    # Métricas geométricas
+    max_y = float(coords[:, 3].max()) / H
+    max_x = float(coords[:, 2].max()) / W
+
+    # Dispersão vertical/horizontal em "faixas": cada faixa vira um bit; o
+    # intervalo [b0, b1] de um bloco é (1<<(b1+1)) - (1<<b0) e a ocupação do
+    # conjunto é um OR-reduce seguido de popcount, sem sets nem broadcast
+    V_BANDS, H_COLS = 8, 4
+    v0 = np.clip((coords[:, 1] / H * V_BANDS).astype(np.int64), 0, V_BANDS - 1)
+    v1 = np.clip((coords[:, 3] / H * V_BANDS).astype(np.int64), 0, V_BANDS - 1)
+    h0 = np.clip((coords[:, 0] / W * H_COLS).astype(np.int64), 0, H_COLS - 1)
+    h1 = np.clip((coords[:, 2] / W * H_COLS).astype(np.int64), 0, H_COLS - 1)
+    v_mask = int(np.bitwise_or.reduce((1 << (v1 + 1)) - (1 << v0)))
+    h_mask = int(np.bitwise_or.reduce((1 << (h1 + 1)) - (1 << h0)))
+    v_occ = v_mask.bit_count()
+    h_occ = h_mask.bit_count()
+
+    # Regras para detectar páginas fragmentadas/problemáticas
+
+    # 1. Fragmentos pequenos concentrados no topo
+    is_small_fragment = (num_blocks <= 3 and max_y <= 0.40 and v_occ <= 2)
+
+    # 2. Páginas com conteúdo espalhado/desorganizado
+    # - Muitos blocos pequenos espalhados
+    # - Sem estrutura principal (sem "DANFE" completo)
+    # - Densidade baixa (muito espaço vazio entre blocos)
+    has_main_structure = "danfe" in text_norm and ("destinatário" in text_norm or "documento auxiliar" in text_norm)
+
+    density = 0.0
+    y_spread = 0.0
+    if not has_main_structure and num_blocks >= 3:
+        # Densidade de conteúdo: reaproveita a soma de áreas já calculada
+        # na filtragem, sem varrer os blocos de novo
+        density = area_text / total_area
+
+        # Verificar se blocos estão muito espalhados
+        y_spread = float(coords[:, 3].max() - coords[:, 1].min()) / H
+
+        # Página fragmentada se:
+        # - Densidade baixa/média (< 35% da página ocupada) OU
+        # - Blocos espalhados (> 70% da altura) E sem estrutura
+        is_scattered_fragment = ((density < 0.35 and y_spread > 0.70) or
+                               (density < 0.20 and y_spread > 0.60))
+    else:
+        is_scattered_fragment = False
+
+    # 3. Páginas com apenas códigos/fragmentos de produtos
+    # - Contém códigos de produto mas sem DANFE
+    # - Texto curto e fragmentado
+    has_product_codes = bool(_PROD_CODE_RE.search(text_norm))  # Mais flexível
+    is_product_fragment = (has_product_codes and not has_main_structure and len(text_norm) < 600)
+
+    return (text_norm, False, is_small_fragment, is_scattered_fragment,
+            is_product_fragment, density, y_spread)
+
+def _open_pdf(source):
+    """Abre um PDF a partir de um caminho no disco ou de bytes em memória."""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return fitz.open(stream=source, filetype='pdf')
+    return fitz.open(source)
+
+def preclean_pdf_remove_overflow_by_blocks(input_pdf_path: str) -> "str | bytes":
     """
     Remove páginas de 'sobra' (continuações/fragmentos da DANFE) antes do processamento principal.
     Heurística baseada em blocos de texto (sem rasterizar):
@@ -32,158 +285,120 @@ def preclean_pdf_remove_overflow_by_blocks(input_pdf_path: str) -> str:
       - blocos não passam de ~40% da altura, nem ocupam mais de 1-2 faixas verticais
       - texto muito semelhante/contido no da página anterior
 
-    Retorna: caminho do PDF limpo (arquivo *_precleaned.pdf) ou o original se nada removido.
+    A análise por página é independente e roda em paralelo (o MuPDF libera o
+    GIL durante get_text); como o mesmo Document não é thread-safe, cada
+    worker abre sua própria cópia e processa uma fatia contígua de páginas.
+    A similaridade com a página anterior depende da ordem, então é resolvida
+    em um segundo passo sequencial sobre os textos já extraídos.
+
+    Retorna: bytes do PDF limpo (mantido em memória, sem ida ao disco) ou o
+    caminho original se nada foi removido.
     """
     import fitz  # PyMuPDF
 
-    def norm_text(s: str) -> str:
-        return re.sub(r"\s+", " ", (s or "")).strip().lower()
-
-    KEEP_HEADERS = [
-        "danfe", "fim do danfe", "chave de acesso",
-        "destinatário", "remetente", "pedido criado", "pieces", "peso",
-        "item", "conteúdo", "atributos", "quant"
-    ]
-
     doc = fitz.open(input_pdf_path)
-    if len(doc) == 0:
+    n_pages = len(doc)
+    if n_pages == 0:
         doc.close()
         return input_pdf_path
 
-    to_drop = set()
-    prev_text_norm = ""
-
-    for i, page in enumerate(doc):
-        W, H = page.rect.width, page.rect.height
-        text_norm = norm_text(page.get_text("text"))
-
-        # Se parecer claramente uma etiqueta/DANFE com cabeçalho, mantém
-        if any(h in text_norm for h in KEEP_HEADERS):
-            prev_text_norm = text_norm
-            continue
-
-        blocks_raw = page.get_text("blocks") or []
-        blocks = []
-        total_area = W * H
-        area_text = 0.0
-
-        # Filtra blocos com texto real e descarta ruídos muito pequenos
-        for b in blocks_raw:
-            if len(b) < 5 or not isinstance(b[4], str) or not b[4].strip():
-                continue
-            x0, y0, x1, y1 = map(float, b[:4])
-            bw, bh = max(0.0, x1 - x0), max(0.0, y1 - y0)
-            if bw * bh < 0.0003 * total_area:
+    try:
+        # 1º passo: métricas por página, em paralelo por fatias contíguas
+        def analyze_slice(page_range):
+            worker_doc = fitz.open(input_pdf_path)
+            try:
+                return [_preclean_analyze_page(worker_doc.load_page(i)) for i in page_range]
+            finally:
+                worker_doc.close()
+
+        n_workers = min(os.cpu_count() or 1, n_pages)
+        if n_workers > 1:
+            chunk = -(-n_pages // n_workers)  # teto da divisão
+            slices = [range(s, min(s + chunk, n_pages)) for s in range(0, n_pages, chunk)]
+            results = [None] * n_pages
+            with ThreadPoolExecutor(max_workers=n_workers) as executor:
+                for page_range, metrics in zip(slices, executor.map(analyze_slice, slices)):
+                    for i, m in zip(page_range, metrics):
+                        results[i] = m
+        else:
+            results = [_preclean_analyze_page(doc.load_page(i)) for i in range(n_pages)]
+
+        # 2º passo (sequencial): similaridade com a página anterior + decisão final
+        to_drop = set()
+        prev_text_norm = ""
+        prev_bits = 0
+
+        # Vocabulário rolante do documento: cada token vira um bit e o conjunto de
+        # tokens de uma página vira um int gigante (bitset). A similaridade Jaccard
+        # passa a ser dois ANDs/ORs + popcount em C, sem hashear token por token.
+        vocab = {}
+
+        def token_bits(s: str) -> int:
+            bits = 0
+            for tok in set(s.split()):
+                idx = vocab.setdefault(tok, len(vocab))
+                bits |= 1 << idx
+            return bits
+
+        for i, metrics in enumerate(results):
+            (text_norm, skip, is_small_fragment, is_scattered_fragment,
+             is_product_fragment, density, y_spread) = metrics
+            bits = token_bits(text_norm)
+
+            if skip:
+                prev_text_norm = text_norm
+                prev_bits = bits
                 continue
-            blocks.append((x0, y0, x1, y1))
-            area_text += bw * bh
 
-        if not blocks:
-            prev_text_norm = text_norm
-            continue
-
-        # Métricas geométricas
-        max_y = max(y1 for _, _, _, y1 in blocks) / H
-        max_x = max(x1 for _, _, x1, _ in blocks) / W
-
-        # Dispersão vertical/horizontal em "faixas"
-        V_BANDS, H_COLS = 8, 4
-        v_occ = set()
-        h_occ = set()
-        for x0, y0, x1, y1 in blocks:
-            v0 = int((y0 / H) * V_BANDS); v1 = int((y1 / H) * V_BANDS)
-            h0 = int((x0 / W) * H_COLS);  h1 = int((x1 / W) * H_COLS)
-            for v in range(max(0, v0), min(V_BANDS - 1, max(0, v1)) + 1):
-                v_occ.add(v)
-            for h in range(max(0, h0), min(H_COLS - 1, max(0, h1)) + 1):
-                h_occ.add(h)
-
-        num_blocks = len(blocks)
-
-        # Similaridade com a página anterior (para detectar "continuação"/repetição)
-        similar_prev = False
-        if prev_text_norm:
-            if text_norm and (text_norm in prev_text_norm or prev_text_norm in text_norm):
-                similar_prev = True
-            else:
-                a, b = set(prev_text_norm.split()), set(text_norm.split())
-                jacc = (len(a & b) / (len(a | b) or 1))
-                if jacc >= 0.60:
+            # Similaridade com a página anterior (para detectar "continuação"/repetição)
+            similar_prev = False
+            if prev_text_norm:
+                if text_norm and (text_norm in prev_text_norm or prev_text_norm in text_norm):
                     similar_prev = True
+                else:
+                    inter = (prev_bits & bits).bit_count()
+                    union = (prev_bits | bits).bit_count()
+                    jacc = inter / (union or 1)
+                    if jacc >= 0.60:
+                        similar_prev = True
+
+            is_continuation = similar_prev
+
+            # Decisão final
+            should_remove = (is_small_fragment or is_continuation or
+                            is_scattered_fragment or is_product_fragment)
+
+            if should_remove:
+                to_drop.add(i)
+                reasons = []
+                if is_small_fragment: reasons.append("SmallFragment")
+                if is_continuation: reasons.append("Continuation")
+                if is_scattered_fragment: reasons.append("ScatteredFragment")
+                if is_product_fragment: reasons.append("ProductFragment")
+
+                logger.debug("[preclean] Página %d marcada para remoção - %s", i + 1, ", ".join(reasons))
+                if is_scattered_fragment:
+                    logger.debug("  └─ Densidade: %.3f, Espalhamento Y: %.3f", density, y_spread)
 
-        # Regras para detectar páginas fragmentadas/problemáticas
-        
-        # 1. Fragmentos pequenos concentrados no topo
-        is_small_fragment = (num_blocks <= 3 and max_y <= 0.40 and len(v_occ) <= 2)
-        
-        # 2. Continuação/repetição da página anterior
-        is_continuation = similar_prev
-        
-        # 3. Páginas com conteúdo espalhado/desorganizado (NOVO)
-        # - Muitos blocos pequenos espalhados
-        # - Sem estrutura principal (sem "DANFE" completo)
-        # - Densidade baixa (muito espaço vazio entre blocos)
-        has_main_structure = "danfe" in text_norm and ("destinatário" in text_norm or "documento auxiliar" in text_norm)
-        
-        if not has_main_structure and num_blocks >= 3:
-            # Calcular densidade de conteúdo
-            total_block_area = sum((x1-x0)*(y1-y0) for x0,y0,x1,y1 in blocks)
-            page_area = W * H
-            density = total_block_area / page_area
-            
-            # Verificar se blocos estão muito espalhados
-            y_positions = [y0 for x0,y0,x1,y1 in blocks] + [y1 for x0,y0,x1,y1 in blocks]
-            y_spread = (max(y_positions) - min(y_positions)) / H if y_positions else 0
-            
-            # Página fragmentada se:
-            # - Densidade baixa/média (< 35% da página ocupada) OU
-            # - Blocos espalhados (> 70% da altura) E sem estrutura
-            is_scattered_fragment = ((density < 0.35 and y_spread > 0.70) or
-                                   (density < 0.20 and y_spread > 0.60))
-        else:
-            is_scattered_fragment = False
-        
-        # 4. Páginas com apenas códigos/fragmentos de produtos (NOVO)
-        # - Contém códigos de produto mas sem DANFE
-        # - Texto curto e fragmentado
-        has_product_codes = bool(re.search(r'i\d{2}[a-z0-9]{6,10}', text_norm))  # Mais flexível
-        is_product_fragment = (has_product_codes and not has_main_structure and len(text_norm) < 600)
-        
-        # Decisão final
-        should_remove = (is_small_fragment or is_continuation or
-                        is_scattered_fragment or is_product_fragment)
-        
-        if should_remove:
-            to_drop.add(i)
-            reasons = []
-            if is_small_fragment: reasons.append("SmallFragment")
-            if is_continuation: reasons.append("Continuation")
-            if is_scattered_fragment: reasons.append("ScatteredFragment")
-            if is_product_fragment: reasons.append("ProductFragment")
-            
-            print(f"[preclean] Página {i+1} marcada para remoção - {', '.join(reasons)}")
-            if is_scattered_fragment:
-                print(f"  └─ Densidade: {density:.3f}, Espalhamento Y: {y_spread:.3f}")
+            prev_text_norm = text_norm
+            prev_bits = bits
 
-        prev_text_norm = text_norm
+        if not to_drop:
+            return input_pdf_path
 
-    if not to_drop:
-        doc.close()
-        return input_pdf_path
+        for i in sorted(to_drop):
+            logger.info("[preclean] removendo página %d (fragmento/continuação)", i + 1)
 
-    cleaned = fitz.open()
-    for i in range(len(doc)):
-        if i in to_drop:
-            print(f"[preclean] removendo página {i+1} (fragmento/continuação)")
-            continue
-        cleaned.insert_pdf(doc, from_page=i, to_page=i)
+        # select() é a API do MuPDF para subconjuntos de páginas: uma única
+        # reescrita da árvore de páginas com coleta de xrefs em lote
+        doc.select([i for i in range(len(doc)) if i not in to_drop])
 
-    base, ext = os.path.splitext(input_pdf_path)
-    out_path = base + "_precleaned" + ext
-    cleaned.save(out_path)
-    cleaned.close()
-    doc.close()
-    return out_path
+        # Serializa direto para memória: o restante do pipeline reabre via
+        # fitz.open(stream=...), sem gravar *_precleaned.pdf no disco
+        cleaned_bytes = doc.tobytes(garbage=3, deflate=True)
+        return cleaned_bytes
+    finally:
+        doc.close()
 
 app = Flask(__name__)
 CORS(app)  # Adiciona suporte CORS para permitir requisições de diferentes origens
@@ -191,23 +406,6 @@ CORS(app)  # Adiciona suporte CORS para permitir requisições de diferentes ori
 # Configurar limite de tamanho de upload para 50MB
 app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024  # 50MB em bytes
 
-# Lista para rastrear arquivos temporários
-temp_files = []  
-
-# Função para limpar arquivos temporários
-def cleanup_temp_files():
-    for file_path in temp_files:
-        try:
-            if os.path.exists(file_path):
-                os.remove(file_path)
-                print(f"Arquivo temporário removido: {file_path}")
-        except Exception as e:
-            print(f"Erro ao remover arquivo temporário {file_path}: {str(e)}")
-    temp_files.clear()
-
-# Registrar função de limpeza para ser executada quando o aplicativo for encerrado
-atexit.register(cleanup_temp_files)
-
 @app.route('/', methods=['GET'])
 def index():
     return render_template('index.html')
@@ -215,168 +413,70 @@ def index():
 @app.route('/processar-pdf', methods=['POST'])
 @app.route('/api/processar-pdf', methods=['POST'])
 def processar_pdf():
-    # Criar arquivos temporários com o módulo tempfile para garantir limpeza adequada
-    input_pdf_fd, input_pdf = tempfile.mkstemp(suffix='.pdf', prefix='temp_input_')
-    output_pdf_fd, output_pdf = tempfile.mkstemp(suffix='.pdf', prefix='temp_output_')
-    
-    # Fechar os descritores de arquivo criados pelo tempfile
-    os.close(input_pdf_fd)
-    os.close(output_pdf_fd)
-    
-    # Adicionar à lista de arquivos temporários para garantir limpeza
-    temp_files.append(input_pdf)
-    temp_files.append(output_pdf)
-    
     try:
         # Verifica se foi enviado um arquivo
         if 'arquivo' not in request.files:
             return jsonify({'erro': 'Nenhum arquivo enviado'}), 400
-            
+
         arquivo = request.files['arquivo']
-        
+
         # Verifica se o nome do arquivo está vazio
         if arquivo.filename == '':
             return jsonify({'erro': 'Nome do arquivo vazio'}), 400
-        
-        # Salva o arquivo temporariamente
-        arquivo.save(input_pdf)
-        
-        # PRE-CLEAN: Remove páginas de sobra/fragmentos antes do processamento principal
-        print("[INFO] Iniciando pré-limpeza do PDF...")
-        cleaned_pdf = preclean_pdf_remove_overflow_by_blocks(input_pdf)
-        
-        # Se foi criado um arquivo limpo, adiciona à lista de arquivos temporários
-        if cleaned_pdf != input_pdf:
-            temp_files.append(cleaned_pdf)
-            print(f"[INFO] PDF pré-limpo salvo em: {cleaned_pdf}")
-        else:
-            print("[INFO] Nenhuma página removida na pré-limpeza")
-        
-        # Processa o PDF (usando o arquivo limpo se disponível)
-        extracted_data = extract_text_from_pdf(cleaned_pdf)
-        if extracted_data:
+
+        # O diretório temporário é removido inteiro na saída do bloco,
+        # inclusive em caso de exceção — sem lista global de arquivos nem
+        # ramos manuais de limpeza (e sem corrida entre threads do Flask)
+        with tempfile.TemporaryDirectory(prefix='danfe_') as td:
+            input_pdf = os.path.join(td, 'in.pdf')
+
+            # Copia o stream do upload direto para o arquivo temporário em chunks
+            # de 1 MB, evitando uma segunda passada pelo buffer do Werkzeug
+            with open(input_pdf, 'wb') as f:
+                shutil.copyfileobj(arquivo.stream, f, length=1 << 20)
+
+            # PRE-CLEAN: Remove páginas de sobra/fragmentos antes do processamento principal
+            print("[INFO] Iniciando pré-limpeza do PDF...")
+            cleaned_pdf = preclean_pdf_remove_overflow_by_blocks(input_pdf)
+
+            # O PDF pré-limpo fica em memória (bytes); nada extra a rastrear em disco
+            if isinstance(cleaned_pdf, (bytes, bytearray)):
+                print(f"[INFO] PDF pré-limpo mantido em memória ({len(cleaned_pdf)} bytes)")
+            else:
+                print("[INFO] Nenhuma página removida na pré-limpeza")
+
+            # Processa o PDF (usando o arquivo limpo se disponível)
+            extracted_data = extract_text_from_pdf(cleaned_pdf)
+            if not extracted_data:
+                return jsonify({
+                    'erro': 'Nenhum dado extraído do PDF', 
+                    'mensagem': 'O PDF enviado não parece conter o formato esperado. Certifique-se de que o PDF contém uma DANFE com a chave de acesso e itens.'
+                }), 400
+
             print(f"[PROCESSAMENTO] Dados extraídos com sucesso: {len(extracted_data)} DANFEs encontradas")
-            pdf_gerado = create_individual_page_pdf(output_pdf, extracted_data, cleaned_pdf)
-            
+            # O PDF gerado volta como bytes direto do canvas: nada de escrever
+            # out.pdf no disco só para relê-lo na resposta
+            pdf_gerado = create_individual_page_pdf(extracted_data, cleaned_pdf)
+
             if not pdf_gerado:
                 print("[PROCESSAMENTO] ERRO: Falha na geração do PDF final")
-                # Limpar arquivos temporários em caso de erro
-                try:
-                    if os.path.exists(input_pdf):
-                        os.remove(input_pdf)
-                        if input_pdf in temp_files:
-                            temp_files.remove(input_pdf)
-                    if os.path.exists(output_pdf):
-                        os.remove(output_pdf)
-                        if output_pdf in temp_files:
-                            temp_files.remove(output_pdf)
-                    if cleaned_pdf != input_pdf and os.path.exists(cleaned_pdf):
-                        os.remove(cleaned_pdf)
-                        if cleaned_pdf in temp_files:
-                            temp_files.remove(cleaned_pdf)
-                except Exception as cleanup_error:
-                    print(f"Erro ao limpar arquivos após falha: {str(cleanup_error)}")
-                
                 return jsonify({
                     'erro': 'Falha na geração do PDF', 
                     'mensagem': 'Os dados foram extraídos mas houve erro na geração do PDF final. Verifique se o PDF contém dados válidos.'
                 }), 500
-            
-            # Registra função para limpar os arquivos após o request
-            @after_this_request
-            def cleanup_after_request(response):
-                try:
-                    # Remover os arquivos temporários após o envio da resposta
-                    if os.path.exists(input_pdf):
-                        os.remove(input_pdf)
-                        if input_pdf in temp_files:
-                            temp_files.remove(input_pdf)
-                        print(f"Arquivo temporário removido após request: {input_pdf}")
-                    if os.path.exists(output_pdf):
-                        os.remove(output_pdf)
-                        if output_pdf in temp_files:
-                            temp_files.remove(output_pdf)
-                        print(f"Arquivo temporário removido após request: {output_pdf}")
-                    # Remover arquivo pré-limpo se existir
-                    if cleaned_pdf != input_pdf and os.path.exists(cleaned_pdf):
-                        os.remove(cleaned_pdf)
-                        if cleaned_pdf in temp_files:
-                            temp_files.remove(cleaned_pdf)
-                        print(f"Arquivo pré-limpo removido após request: {cleaned_pdf}")
-                except Exception as e:
-                    print(f"Erro ao remover arquivos temporários após request: {str(e)}")
-                return response
-            
-            # Envia o arquivo processado como resposta
-            try:
-                response = send_file(
-                    output_pdf,
-                    mimetype='application/pdf',
-                    as_attachment=True,
-                    download_name='processado.pdf'
-                )
-                
-                return response
-            except Exception as e:
-                # Se houver erro ao enviar o arquivo, tenta remover os temporários
-                print(f"Erro ao enviar o arquivo: {str(e)}")
-                try:
-                    if os.path.exists(input_pdf):
-                        os.remove(input_pdf)
-                        temp_files.remove(input_pdf)
-                    if os.path.exists(output_pdf):
-                        os.remove(output_pdf)
-                        temp_files.remove(output_pdf)
-                except Exception as cleanup_error:
-                    print(f"Erro ao limpar arquivos após falha de envio: {str(cleanup_error)}")
-                raise
-        else:
-            # Se não extraiu dados, remove o arquivo de entrada
-            try:
-                if os.path.exists(input_pdf):
-                    os.remove(input_pdf)
-                    if input_pdf in temp_files:
-                        temp_files.remove(input_pdf)
-                if os.path.exists(output_pdf):
-                    os.remove(output_pdf)
-                    if output_pdf in temp_files:
-                        temp_files.remove(output_pdf)
-                # Remover arquivo pré-limpo se existir
-                if cleaned_pdf != input_pdf and os.path.exists(cleaned_pdf):
-                    os.remove(cleaned_pdf)
-                    if cleaned_pdf in temp_files:
-                        temp_files.remove(cleaned_pdf)
-            except Exception as e:
-                print(f"Erro ao remover arquivos temporários: {str(e)}")
-                
-            return jsonify({
-                'erro': 'Nenhum dado extraído do PDF', 
-                'mensagem': 'O PDF enviado não parece conter o formato esperado. Certifique-se de que o PDF contém uma DANFE com a chave de acesso e itens.'
-            }), 400
-            
+
+        return send_file(
+            io.BytesIO(pdf_gerado),
+            mimetype='application/pdf',
+            as_attachment=True,
+            download_name='processado.pdf'
+        )
+
     except Exception as e:
         # Log do erro completo para debug
         error_trace = traceback.format_exc()
         print(error_trace)
-        
-        # Limpar arquivos temporários em caso de erro
-        try:
-            if os.path.exists(input_pdf):
-                os.remove(input_pdf)
-                if input_pdf in temp_files:
-                    temp_files.remove(input_pdf)
-            if os.path.exists(output_pdf):
-                os.remove(output_pdf)
-                if output_pdf in temp_files:
-                    temp_files.remove(output_pdf)
-            # Remover arquivo pré-limpo se existir
-            if 'cleaned_pdf' in locals() and cleaned_pdf != input_pdf and os.path.exists(cleaned_pdf):
-                os.remove(cleaned_pdf)
-                if cleaned_pdf in temp_files:
-                    temp_files.remove(cleaned_pdf)
-        except Exception as cleanup_error:
-            print(f"Erro ao limpar arquivos temporários: {str(cleanup_error)}")
-        
+
         # Mensagem de erro mais amigável para o usuário
         error_message = str(e)
         if "already being used by another process" in error_message:
@@ -385,7 +485,7 @@ def processar_pdf():
             user_message = "Erro de permissão ao acessar os arquivos. Por favor, tente novamente."
         else:
             user_message = "Ocorreu um erro ao processar o PDF. Por favor, verifique se o formato está correto e tente novamente."
-            
+
         return jsonify({
             'erro': str(e),
             'mensagem': user_message
@@ -394,201 +494,336 @@ def processar_pdf():
 # Resto do código permanece igual
 def extract_text_from_pdf(input_pdf):
     inicio = time.time()
-    doc = fitz.open(input_pdf)
+    doc = _open_pdf(input_pdf)
     extracted_data = []
-    page_num = 0
-    
-    print(f"[EXTRAÇÃO] Iniciando extração de {doc.page_count} páginas")
-    
-    while page_num < doc.page_count:
-        page = doc.load_page(page_num)
-        text = page.get_text("text")
-        
-        print(f"[EXTRAÇÃO] Analisando página {page_num + 1}")
 
-        # Verificação mais flexível para DANFE
-        if not ("DANFE" in text.upper() or text.startswith("DANFE")):
-            print(f"[EXTRAÇÃO] Página {page_num + 1} não contém DANFE, pulando...")
-            page_num += 1
-            continue
+    logger.info("[EXTRAÇÃO] Iniciando extração de %d páginas", doc.page_count)
 
-        try:
-            # Busca mais robusta pela chave de acesso
-            chave_acesso = None
-            chave_patterns = ["CHAVE DE ACESSO", "CHAVE DE ACESSO:", "CHAVE ACESSO"]
-            
-            for pattern in chave_patterns:
-                if pattern in text:
-                    chave_acesso_index = text.index(pattern)
-                    chave_linha = text[chave_acesso_index + len(pattern):].strip().split('\n')[0]
-                    # Limpar a chave de acesso (remover espaços e caracteres especiais)
-                    chave_acesso = ''.join(c for c in chave_linha if c.isdigit())
-                    if len(chave_acesso) >= 40:  # Chave de acesso válida tem 44 dígitos
-                        break
-                    else:
-                        chave_acesso = None
-            
-            if not chave_acesso:
-                print(f"[EXTRAÇÃO] ERRO: Chave de acesso não encontrada na página {page_num + 1}")
-                page_num += 1
-                continue
-                
-            print(f"[EXTRAÇÃO] Chave de acesso encontrada: {chave_acesso[:10]}...")
+    # Passada única e sequencial: cada página é carregada no máximo uma vez.
+    # Quando o texto da página seguinte já foi lido no lookahead de
+    # continuação, ele fica em pending_text e é reaproveitado; se foi
+    # consumido como continuação, a página é pulada via skip_next.
+    pending_text = None
+    skip_next = False
 
-            # Busca mais robusta pelos itens
-            item_patterns = ["ITEM", "CÓDIGO", "DESCRIÇÃO"]
-            item_index = -1
-            
-            for pattern in item_patterns:
-                if pattern in text:
-                    item_index = text.index(pattern)
-                    break
-            
-            if item_index == -1:
-                print(f"[EXTRAÇÃO] ERRO: Seção de itens não encontrada na página {page_num + 1}")
-                page_num += 1
+    # O fechamento fica num finally: uma exceção fora do try por página
+    # não pode vazar o Document (e o heap C do MuPDF) do loop inteiro
+    try:
+        for page_num in range(doc.page_count):
+            text = pending_text
+            pending_text = None
+
+            if skip_next:
+                skip_next = False
+                logger.debug("[EXTRAÇÃO] Página %d já consumida como continuação, pulando...", page_num + 1)
                 continue
 
-            texto_completo = text[item_index:]
+            if text is None:
+                text = doc.load_page(page_num).get_text("text")
 
-            # Verificar próxima página para continuação
-            proxima_pagina = page_num + 1
-            if proxima_pagina < doc.page_count:
-                next_page = doc.load_page(proxima_pagina)
-                if not next_page.get_images():
-                    next_text = next_page.get_text("text")
-                    if next_text and not "DANFE" in next_text.upper():
-                        texto_completo += "\n" + next_text
-                        print(f"[EXTRAÇÃO] Incluindo continuação da página {proxima_pagina + 1}")
+            logger.debug("[EXTRAÇÃO] Analisando página %d", page_num + 1)
 
-            # Processamento de Itens - Abordagem híbrida melhorada
-            linhas = texto_completo.strip().split('\n')
-            itens = []
-            item_atual = []
-            
-            print(f"[EXTRAÇÃO] Processando {len(linhas)} linhas para extrair itens...")
-            print(f"[EXTRAÇÃO] DEBUG - Primeiras 10 linhas do texto:")
-            for i, linha in enumerate(linhas[:10]):
-                print(f"[EXTRAÇÃO] Linha {i}: '{linha.strip()}'")
+            # Verificação mais flexível para DANFE
+            if not ("DANFE" in text.upper() or text.startswith("DANFE")):
+                logger.debug("[EXTRAÇÃO] Página %d não contém DANFE, pulando...", page_num + 1)
+                continue
+
+            try:
+                # Busca mais robusta pela chave de acesso
+                chave_acesso = None
+                chave_patterns = ["CHAVE DE ACESSO", "CHAVE DE ACESSO:", "CHAVE ACESSO"]
             
-            quantidade_atual = "1"  # Quantidade padrão
+                for pattern in chave_patterns:
+                    if pattern in text:
+                        chave_acesso_index = text.index(pattern)
+                        chave_linha = text[chave_acesso_index + len(pattern):].strip().split('\n')[0]
+                        # Limpar a chave de acesso (remover espaços e caracteres especiais)
+                        chave_acesso = ''.join(c for c in chave_linha if c.isdigit())
+                        if len(chave_acesso) >= 40:  # Chave de acesso válida tem 44 dígitos
+                            break
+                        else:
+                            chave_acesso = None
             
-            for i, linha in enumerate(linhas[1:]):  # Pular primeira linha (cabeçalho)
-                linha_limpa = linha.strip()
-                
-                # Pular linhas vazias ou cabeçalhos conhecidos
-                if not linha_limpa or linha_limpa in ["CONTEÚDO", "ATRIBUTOS", "QUANT.", "DESCRIÇÃO", "CÓDIGO"]:
+                if not chave_acesso:
+                    logger.warning("[EXTRAÇÃO] ERRO: Chave de acesso não encontrada na página %d", page_num + 1)
                     continue
                 
-                # Detectar quantidade após QUANT.
-                if i > 0 and "QUANT." in linhas[i].upper():
-                    # Procurar quantidade na próxima linha ou na mesma linha
-                    linha_quant = linha_limpa
-                    if linha_quant.isdigit():
-                        quantidade_atual = linha_quant
-                        print(f"[EXTRAÇÃO] Quantidade encontrada: '{quantidade_atual}'")
-                        continue
-                    # Se não encontrou na linha atual, procurar na próxima
-                    elif i + 1 < len(linhas):
-                        proxima_linha = linhas[i + 1].strip()
-                        if proxima_linha.isdigit():
-                            quantidade_atual = proxima_linha
-                            print(f"[EXTRAÇÃO] Quantidade encontrada na próxima linha: '{quantidade_atual}'")
-                
-                # Detectar início de novo item - deve ser um código que começa com letra/número longo
-                # ou um número sequencial pequeno APENAS se não temos item atual
-                is_new_item = False
-                
-                # Se não temos item atual e é um número pequeno, pode ser início de item
-                if not item_atual and linha_limpa.isdigit() and len(linha_limpa) <= 2 and int(linha_limpa) <= 50:
-                    is_new_item = True
-                    print(f"[EXTRAÇÃO] Detectado início de novo item (número sequencial): '{linha_limpa}'")
-                
-                # Se parece com um código (letras + números, mais de 5 caracteres)
-                elif re.match(r'^[A-Za-z0-9]{5,}', linha_limpa) and not item_atual:
-                    is_new_item = True
-                    print(f"[EXTRAÇÃO] Detectado início de novo item (código): '{linha_limpa}'")
-                
-                if is_new_item:
-                    # Salvar item anterior se existir
-                    if item_atual and len(item_atual) >= 2:
-                        codigo = item_atual[0]
-                        conteudo = " ".join(item_atual[1:])
-                        if codigo and conteudo and len(codigo) > 3:  # Validar código mínimo
-                            itens.append([codigo, conteudo, quantidade_atual])
-                            print(f"[EXTRAÇÃO] Item adicionado: Código='{codigo}', Desc='{conteudo[:30]}...', Qtd='{quantidade_atual}'")
-                    item_atual = []
-                    quantidade_atual = "1"  # Reset quantidade para próximo item
-                
-                if linha_limpa:
-                    # Adicionar linha ao item atual
-                    item_atual.append(linha_limpa)
-                    print(f"[EXTRAÇÃO] Linha adicionada ao item: '{linha_limpa[:50]}...'")
+                logger.debug("[EXTRAÇÃO] Chave de acesso encontrada: %s...", chave_acesso[:10])
+
+                # Busca mais robusta pelos itens
+                item_patterns = ["ITEM", "CÓDIGO", "DESCRIÇÃO"]
+                item_index = -1
             
-            # Processar último item se existir
-            if item_atual and len(item_atual) >= 2:
-                codigo = item_atual[0]
-                conteudo = " ".join(item_atual[1:])
-                if codigo and conteudo and len(codigo) > 3:
-                    itens.append([codigo, conteudo, quantidade_atual])
-                    print(f"[EXTRAÇÃO] Último item adicionado: Código='{codigo}', Desc='{conteudo[:30]}...', Qtd='{quantidade_atual}'")
+                for pattern in item_patterns:
+                    if pattern in text:
+                        item_index = text.index(pattern)
+                        break
             
-            print(f"[EXTRAÇÃO] Total de itens extraídos: {len(itens)}")
+                if item_index == -1:
+                    logger.warning("[EXTRAÇÃO] ERRO: Seção de itens não encontrada na página %d", page_num + 1)
+                    continue
 
-            # Validar se extraiu dados válidos
-            if itens:
-                extracted_data.append([chave_acesso, itens])
-                print(f"[EXTRAÇÃO] Sucesso: {len(itens)} itens extraídos da página {page_num + 1}")
-            else:
-                print(f"[EXTRAÇÃO] AVISO: Nenhum item válido extraído da página {page_num + 1}")
+                texto_completo = text[item_index:]
 
-        except ValueError as e:
-            print(f"[EXTRAÇÃO] ERRO: Falha ao extrair dados na página {page_num + 1}: {str(e)}")
-        except Exception as e:
-            print(f"[EXTRAÇÃO] ERRO INESPERADO na página {page_num + 1}: {str(e)}")
+                # Verificar próxima página para continuação (o texto extraído aqui
+                # é guardado em pending_text para a próxima iteração não reextrair)
+                proxima_pagina = page_num + 1
+                if proxima_pagina < doc.page_count:
+                    # O que determina continuação é a ausência de "DANFE" no texto;
+                    # não precisamos pagar um get_images() (varredura completa do
+                    # dicionário de recursos) só para responder um booleano
+                    next_page = doc.load_page(proxima_pagina)
+                    next_text = next_page.get_text("text")
+                    pending_text = next_text
+                    if next_text and not "DANFE" in next_text.upper():
+                        texto_completo += "\n" + next_text
+                        skip_next = True
+                        logger.debug("[EXTRAÇÃO] Incluindo continuação da página %d", proxima_pagina + 1)
+
+                # Processamento de Itens: uma única varredura com regex compilada
+                # (registro = linha de código, linhas de descrição, bloco QUANT.
+                # opcional), em vez do loop linha a linha com estado manual
+                itens = []
+                for m in _ITEM_RECORD_RE.finditer(texto_completo):
+                    codigo = m['cod']
+                    desc_linhas = (l.strip() for l in m['desc'].split('\n'))
+                    conteudo = " ".join(
+                        l for l in desc_linhas if l and l not in _ITEM_HEADER_LINES
+                    )
+                    if conteudo and len(codigo) > 3:  # Validar código mínimo
+                        itens.append([codigo, conteudo, m['qtd'] or "1"])
+
+                logger.debug("[EXTRAÇÃO] Total de itens extraídos: %d", len(itens))
+
+                # Validar se extraiu dados válidos
+                if itens:
+                    extracted_data.append([chave_acesso, itens])
+                    logger.debug("[EXTRAÇÃO] Sucesso: %d itens extraídos da página %d", len(itens), page_num + 1)
+                else:
+                    logger.warning("[EXTRAÇÃO] AVISO: Nenhum item válido extraído da página %d", page_num + 1)
 
-        page_num += 2
+            except ValueError as e:
+                logger.warning("[EXTRAÇÃO] ERRO: Falha ao extrair dados na página %d: %s", page_num + 1, e)
+            except Exception as e:
+                logger.warning("[EXTRAÇÃO] ERRO INESPERADO na página %d: %s", page_num + 1, e)
 
-    doc.close()
+    finally:
+        doc.close()
     fim = time.time()
-    print(f"[EXTRAÇÃO] Concluída em {fim - inicio:.2f}s - {len(extracted_data)} DANFEs processadas")
+    logger.info("[EXTRAÇÃO] Concluída em %.2fs - %d DANFEs processadas", fim - inicio, len(extracted_data))
     
     # Validação final
     if not extracted_data:
-        print("[EXTRAÇÃO] ERRO: Nenhum dado válido foi extraído do PDF")
+        logger.warning("[EXTRAÇÃO] ERRO: Nenhum dado válido foi extraído do PDF")
     
     return extracted_data
 
-def create_individual_page_pdf(output_pdf, data, input_pdf):
+# ==============================
+# Preparação por DANFE em processos worker: cada DANFE é independente até o
+# momento de desenhar no canvas, então a parte pesada (quebra de texto,
+# varredura de páginas e extração/raster de imagem no MuPDF) roda em paralelo.
+# Objetos do MuPDF não são picklable: cada processo abre sua própria cópia do
+# documento uma única vez, no initializer do pool. Os globais de módulo são
+# exclusivos dos processos worker (um por processo, sem concorrência); no
+# processo do Flask — que atende requisições em threads — a preparação usa
+# _prepare_danfe_impl com documento e cache locais da requisição.
+# ==============================
+_PREP_DOC = None
+_PREP_PAGE_INFO = None
+
+def _prep_worker_init(pdf_source):
+    global _PREP_DOC, _PREP_PAGE_INFO
+    _PREP_DOC = _open_pdf(pdf_source)
+    _PREP_PAGE_INFO = {}
+
+def _prepare_danfe(task):
+    # Wrapper picklable para executor.map: lê o documento/cache do processo
+    # worker corrente
+    return _prepare_danfe_impl(_PREP_DOC, _PREP_PAGE_INFO, task)
+
+def _page_info(doc, cache, pagina_num):
+    # Cache por página fonte: as janelas de busca [i*2, i*2+2] de DANFEs
+    # vizinhas se sobrepõem, então cada página seria carregada e classificada
+    # duas vezes sem isto
+    info = cache.get(pagina_num)
+    if info is None:
+        page = doc.load_page(pagina_num)
+        has_images = bool(page.get_images())
+        is_danfe_main = False
+        if has_images:
+            # Varre bloco a bloco com saída antecipada: numa DANFE o
+            # cabeçalho está nos primeiros blocos, então quase nunca é
+            # preciso subir (upper) e examinar o texto da página inteira
+            tem_danfe = tem_chave = False
+            for blk in page.get_text("blocks") or []:
+                if len(blk) >= 5 and isinstance(blk[4], str):
+                    s = blk[4].upper()
+                    tem_danfe = tem_danfe or "DANFE" in s
+                    tem_chave = tem_chave or "CHAVE DE ACESSO" in s
+                    if tem_danfe and tem_chave:
+                        is_danfe_main = True
+                        break
+        info = (page, has_images, is_danfe_main)
+        cache[pagina_num] = info
+    return info
+
+def _prepare_danfe_impl(doc, page_info, task):
+    """
+    Prepara uma DANFE: valida os dados, monta as linhas da tabela e extrai os
+    bytes da imagem do produto de `doc` (com `page_info` como cache de
+    classificação de páginas). Devolve (i, table_data, img_data); table_data
+    vazio significa "pular esta DANFE" (o aviso correspondente já foi emitido
+    aqui). Só o desenho no canvas — a única dependência serial — fica com a
+    thread principal.
+    """
+    i, row = task
+    try:
+        chave_acesso, itens = row
+
+        # Validações robustas
+        if not chave_acesso or not itens:
+            logger.warning("[GERAÇÃO] AVISO: DANFE %d tem dados inválidos (chave: %s, itens: %d)", i + 1, bool(chave_acesso), len(itens) if itens else 0)
+            return i, None, None
+
+        if len(chave_acesso) < 40:
+            logger.warning("[GERAÇÃO] AVISO: Chave de acesso inválida na DANFE %d: %s", i + 1, chave_acesso)
+            return i, None, None
+
+        logger.debug("[GERAÇÃO] Processando DANFE %d: %d itens", i + 1, len(itens))
+
+        # Filtro de validade em uma única list comprehension (formato com 3
+        # campos e código/conteúdo não vazios), seguida da montagem da tabela:
+        # o interpretador itera em um laço especializado, sem os desvios e
+        # logs por item da versão anterior
+        itens_ok = [
+            (item[0], item[1], item[2])
+            for item in itens
+            if len(item) >= 3 and item[0] and item[1]
+        ]
+        table_data = [
+            [
+                # Normaliza espaços, remove caracteres especiais, corrige
+                # palavras cortadas e quebra em linhas (com cache por SKU)
+                _quebrar_texto_cacheado(
+                    f"Código: {codigo}\n"
+                    f"{corrigir_palavras_cortadas(_WS_RE.sub(' ', conteudo.strip()).translate(_STRIP_TBL))}",
+                    112,
+                ),
+                quantidade,
+            ]
+            for codigo, conteudo, quantidade in itens_ok
+        ]
+
+        if not table_data:
+            logger.warning("[GERAÇÃO] ERRO: Nenhum item válido encontrado na DANFE %d", i + 1)
+            return i, None, None
+
+        # Resumo único por DANFE, em vez de um log por item ignorado
+        logger.debug("[GERAÇÃO] %d itens válidos (%d ignorados) para DANFE %d", len(table_data), len(itens) - len(itens_ok), i + 1)
+
+        # Tabelas com mais de 4 linhas são desenhadas sozinhas em página nova
+        # (o desenho chama showPage antes de posicioná-las): não vale pagar a
+        # carga/classificação de páginas no MuPDF — e um possível raster a
+        # 200 DPI — por uma imagem que não seria aproveitada
+        if len(table_data) > 4:
+            logger.debug("[GERAÇÃO] DANFE %d tem tabela longa; busca de imagem pulada", i + 1)
+            return i, table_data, None
+
+        # Buscar imagem com lógica melhorada
+        img_data = None
+
+        # Buscar em múltiplas páginas relacionadas à DANFE atual
+        paginas_para_buscar = [i * 2, i * 2 + 1]
+        if i * 2 + 2 < doc.page_count:
+            paginas_para_buscar.append(i * 2 + 2)
+
+        for pagina_num in paginas_para_buscar:
+            if pagina_num < doc.page_count:
+                page, has_images, is_danfe_main = _page_info(doc, page_info, pagina_num)
+                # Aceitar páginas com imagem que não sejam DANFE principal
+                if has_images and not is_danfe_main:
+                    logger.debug("[GERAÇÃO] Imagem encontrada na página %d para DANFE %d", pagina_num + 1, i + 1)
+                    pix = None
+                    try:
+                        # Preferência: copiar os bytes da imagem já codificados
+                        # do stream do PDF (extract_image), sem rasterizar a
+                        # página inteira a 200 DPI. Só cai para o raster se o
+                        # codec embutido não for um formato que o ReportLab
+                        # leia direto.
+                        imagens_embutidas = page.get_images(full=True)
+                        if imagens_embutidas:
+                            base_img = doc.extract_image(imagens_embutidas[0][0])
+                            if base_img and base_img.get('ext') in ('jpeg', 'jpg', 'png') and base_img.get('image'):
+                                img_data = base_img['image']
+
+                        if img_data is None:
+                            # Fallback: rasteriza e codifica o JPEG na camada C
+                            # do MuPDF (tobytes), sem cruzar para o PIL nem
+                            # copiar os samples para um buffer intermediário.
+                            # O DPI é o mínimo que cobre a largura de desenho
+                            # no canvas a ~144 px/pol (custo e memória do
+                            # raster crescem com o quadrado do DPI); 200 segue
+                            # como teto e 96 como piso de segurança.
+                            largura_desenho = _PAGE_SIZE[0] - 1.5 * cm
+                            target_px = largura_desenho / 72 * 144
+                            dpi = max(96, min(200, int(target_px * 72 / page.rect.width) + 8))
+                            pix = page.get_pixmap(alpha=False, dpi=dpi, colorspace=fitz.csRGB)
+                            img_data = pix.tobytes(output='jpeg', jpg_quality=85)
+                    except Exception as e:
+                        logger.warning("[GERAÇÃO] ERRO ao extrair imagem para DANFE %d: %s", i + 1, e)
+                        img_data = None
+                    finally:
+                        # Libera o buffer C do MuPDF já — sem esperar o GC e
+                        # mesmo quando o raster/encode falha no meio — para a
+                        # memória do worker não crescer com o número de DANFEs
+                        if pix is not None:
+                            pix = None
+                            fitz.TOOLS.store_shrink(100)
+                    break
+
+        if img_data is None:
+            logger.debug("[GERAÇÃO] Nenhuma imagem encontrada para DANFE %d", i + 1)
+
+        return i, table_data, img_data
+
+    except Exception as e:
+        logger.warning("[GERAÇÃO] ERRO INESPERADO ao preparar DANFE %d: %s", i + 1, e)
+        return i, None, None
+
+def create_individual_page_pdf(data, input_pdf):
     inicio = time.time()
     
     # Validação inicial dos dados
     if not data:
-        print("[GERAÇÃO] ERRO: Nenhum dado fornecido para gerar PDF")
+        logger.warning("[GERAÇÃO] ERRO: Nenhum dado fornecido para gerar PDF")
         return False
         
-    print(f"[GERAÇÃO] Iniciando geração de PDF com {len(data)} DANFEs")
+    logger.info("[GERAÇÃO] Iniciando geração de PDF com %d DANFEs", len(data))
     
-    doc = fitz.open(input_pdf)
-    c = canvas.Canvas(output_pdf, pagesize=(799, 1197))
+    # O canvas escreve em um buffer em memória: c.save() deixa de custar um
+    # flush em disco e o chamador consome os bytes direto (send_file/BytesIO).
+    # pageCompression deflata o content stream de cada página assim que ela
+    # fecha, então o pico de memória (e o PDF final) não cresce com streams
+    # crus acumulados até o save()
+    out_buf = io.BytesIO()
+    c = canvas.Canvas(out_buf, pagesize=_PAGE_SIZE, pageCompression=1)
     width, height = c._pagesize
-    
+
     paginas_geradas = 0
 
-    for i, row in enumerate(data):
+    # Buffer único para os bytes de imagem, reciclado com seek/truncate:
+    # evita alocar (e depois coletar) um BytesIO de MBs por DANFE
+    img_buf = io.BytesIO()
+
+    def desenhar_danfe(prep):
+        """Desenha no canvas uma DANFE já preparada por _prepare_danfe."""
+        nonlocal paginas_geradas
+        i, table_data, img_data = prep
+        if not table_data:
+            # Dados inválidos — o aviso já saiu do worker
+            return
         try:
-            chave_acesso, itens = row
-            
-            # Validações robustas
-            if not chave_acesso or not itens:
-                print(f"[GERAÇÃO] AVISO: DANFE {i+1} tem dados inválidos (chave: {bool(chave_acesso)}, itens: {len(itens) if itens else 0})")
-                continue
-                
-            if len(chave_acesso) < 40:
-                print(f"[GERAÇÃO] AVISO: Chave de acesso inválida na DANFE {i+1}: {chave_acesso}")
-                continue
-                
-            print(f"[GERAÇÃO] Processando DANFE {i+1}: {len(itens)} itens")
+            chave_acesso = data[i][0]
 
             # Gerar código de barras
             try:
@@ -597,10 +832,10 @@ def create_individual_page_pdf(output_pdf, data, input_pdf):
                 c.rotate(90)
                 barcode.drawOn(c, height - 14.00 * cm - 0.80 * cm, -width + 0.50 * cm)
                 c.restoreState()
-                print(f"[GERAÇÃO] Código de barras gerado para DANFE {i+1}")
+                logger.debug("[GERAÇÃO] Código de barras gerado para DANFE %d", i + 1)
             except Exception as e:
-                print(f"[GERAÇÃO] ERRO ao gerar código de barras para DANFE {i+1}: {str(e)}")
-                continue
+                logger.warning("[GERAÇÃO] ERRO ao gerar código de barras para DANFE %d: %s", i + 1, e)
+                return
 
             # Texto da chave de acesso
             text_x = width - 0.10 * cm
@@ -611,215 +846,115 @@ def create_individual_page_pdf(output_pdf, data, input_pdf):
             c.drawString(0, 0, chave_acesso)
             c.restoreState()
 
-            # Preparar dados da tabela com validação
-            table_data = []
-            itens_validos = 0
-            
-            for item in itens:
-                if len(item) >= 3:
-                    codigo, conteudo, quantidade = item[0], item[1], item[2]
-                    
-                    # Validar que os dados não estão vazios
-                    if codigo and conteudo:
-                        # Função para corrigir palavras cortadas
-                        def corrigir_palavras_cortadas(texto):
-                            # Dicionário de correções comuns
-                            correcoes = {
-                                r'\bU\s+nissex\b': 'Unissex',
-                                r'\bSkat\s+ista\b': 'Skatista', 
-                                r'\bMa\s+sculino\b': 'Masculino',
-                                r'\bFe\s+minino\b': 'Feminino',
-                                r'\bPre\s+mium\b': 'Premium',
-                                r'\bCas\s+ual\b': 'Casual',
-                                r'\bCam\s+pus\b': 'Campus',
-                                r'\bTê\s+nis\b': 'Tênis',
-                                r'\bSka\s+te\b': 'Skate',
-                                r'\bCon\s+fortável\b': 'Confortável',
-                                r'\bLan\s+çamento\b': 'Lançamento',
-                                r'\bDia\s+a\s+Dia\b': 'Dia a Dia',
-                                r'\bSu\s+per\b': 'Super',
-                                r'\bLi\s+nha\b': 'Linha',
-                                r'\bMo\s+retto\b': 'Moretto'
-                            }
-                            
-                            texto_corrigido = texto
-                            for padrao, correcao in correcoes.items():
-                                texto_corrigido = re.sub(padrao, correcao, texto_corrigido, flags=re.IGNORECASE)
-                            
-                            return texto_corrigido
-                        
-                        # Limpar e normalizar a descrição
-                        conteudo_limpo = re.sub(r'\s+', ' ', conteudo.strip())  # Remove espaços extras
-                        conteudo_limpo = re.sub(r'[■□▪▫]', '', conteudo_limpo)  # Remove caracteres especiais
-                        conteudo_limpo = corrigir_palavras_cortadas(conteudo_limpo)  # Corrige palavras cortadas
-                        
-                        # Incluir código junto com a descrição
-                        produto_completo = f"Código: {codigo}\n{conteudo_limpo}"
-                        
-                        # Função para quebrar texto sem cortar palavras
-                        def quebrar_texto_inteligente(texto, largura_maxima=112):  # Alterado para 112 caracteres
-                            linhas = []
-                            palavras = texto.split()
-                            linha_atual = ""
-                            
-                            for palavra in palavras:
-                                # Se adicionar a palavra não ultrapassar o limite
-                                if len(linha_atual + " " + palavra) <= largura_maxima:
-                                    if linha_atual:
-                                        linha_atual += " " + palavra
-                                    else:
-                                        linha_atual = palavra
-                                else:
-                                    # Se a linha atual não está vazia, adiciona às linhas
-                                    if linha_atual:
-                                        linhas.append(linha_atual)
-                                        linha_atual = palavra
-                                    else:
-                                        # Palavra muito longa, força quebra
-                                        linhas.append(palavra[:largura_maxima])
-                                        linha_atual = palavra[largura_maxima:]
-                            
-                            # Adiciona a última linha se não estiver vazia (FORA do loop)
-                            if linha_atual:
-                                linhas.append(linha_atual)
-                            
-                            return "\n".join(linhas)
-                        
-                        # Quebrar conteúdo em linhas para melhor formatação
-                        produto_quebrado = quebrar_texto_inteligente(produto_completo, 112)  # Usar largura de 112
-                        table_data.append([produto_quebrado, quantidade])
-                        itens_validos += 1
-                        print(f"[GERAÇÃO] Item formatado: {len(produto_quebrado.split())} linhas")
-                    else:
-                        print(f"[GERAÇÃO] Item inválido ignorado na DANFE {i+1}: código='{codigo}', conteúdo='{conteudo}'")
-                else:
-                    print(f"[GERAÇÃO] Item com formato inválido ignorado na DANFE {i+1}: {item}")
+            # Criar tabela (estilo e larguras de coluna são constantes de módulo)
+            table = Table(table_data, colWidths=_COL_WIDTHS)
+            table.setStyle(_DANFE_STYLE_LARGE if len(table_data) > 4 else _DANFE_STYLE_SMALL)
 
-            if not table_data:
-                print(f"[GERAÇÃO] ERRO: Nenhum item válido encontrado na DANFE {i+1}")
-                continue
-                
-            print(f"[GERAÇÃO] {itens_validos} itens válidos processados para DANFE {i+1}")
-
-            # Criar tabela
-            table_width = width * 0.98
-            col_widths = [table_width * 0.85, table_width * 0.15]  # Melhor distribuição: 85% descrição, 15% quantidade
-            table = Table(table_data, colWidths=col_widths)
-
-            style = TableStyle([
-                ('BACKGROUND', (0, 0), (-1, -1), colors.white),
-                ('TEXTCOLOR', (0, 0), (-1, -1), colors.black),
-                ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-                ('ALIGN', (1, 0), (1, -1), 'CENTER'),  # Centralizar quantidade
-                ('FONTNAME', (0, 0), (-1, -1), 'Helvetica-Bold'),
-                ('FONTSIZE', (0, 0), (-1, -1), 12),  # Fonte 12pt para máximo aproveitamento
-                ('BOTTOMPADDING', (0, 0), (-1, -1), 2),  # Padding mínimo inferior (2pt)
-                ('TOPPADDING', (0, 0), (-1, -1), 2),    # Padding mínimo superior (2pt)
-                ('LEFTPADDING', (0, 0), (-1, -1), 3),   # Padding mínimo esquerdo (3pt)
-                ('RIGHTPADDING', (0, 0), (-1, -1), 3),  # Padding mínimo direito (3pt)
-                ('GRID', (0, 0), (-1, -1), 0.5, colors.black),
-                ('NOSPLIT', (0, 0), (-1, -1)),
-                ('WORDWRAP', (0, 0), (-1, -1)),
-                ('ROWHEIGHT', (0, 0), (-1, -1), 100),
-                ('LEADING', (0, 0), (-1, -1), 14)  # Espaçamento mínimo entre linhas (14pt)
-            ])
-            table.setStyle(style)
-
-            # Buscar imagem com lógica melhorada
-            img_height = 0
-            pagina_com_imagem = None
-            
-            # Buscar em múltiplas páginas relacionadas à DANFE atual
-            paginas_para_buscar = [i * 2, i * 2 + 1]
-            if i * 2 + 2 < doc.page_count:
-                paginas_para_buscar.append(i * 2 + 2)
-                
-            for pagina_num in paginas_para_buscar:
-                if pagina_num < doc.page_count:
-                    page = doc.load_page(pagina_num)
-                    if page.get_images():
-                        text = page.get_text("text")
-                        # Aceitar páginas com imagem que não sejam DANFE principal
-                        if not ("DANFE" in text.upper() and "CHAVE DE ACESSO" in text.upper()):
-                            pagina_com_imagem = page
-                            print(f"[GERAÇÃO] Imagem encontrada na página {pagina_num + 1} para DANFE {i+1}")
-                            break
+            # Mede o layout uma única vez: Table.wrap refaz o layout completo
+            # a cada chamada, então a altura é cacheada e reutilizada abaixo
+            table_height = table.wrapOn(c, width, height)[1]
 
-            # Processar imagem se encontrada
-            if pagina_com_imagem:
+            # Desenhar a imagem preparada pelo worker, se houver
+            img_height = 0
+            if img_data:
                 try:
-                    pix = pagina_com_imagem.get_pixmap(alpha=False, dpi=200)
-                    img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-                    img_bytes = io.BytesIO()
-                    img.save(img_bytes, format='JPEG')
-                    img_bytes.seek(0)
-                    img_reader = ImageReader(img_bytes)
+                    # drawImage consome o buffer de forma síncrona, então é
+                    # seguro reciclá-lo na próxima iteração
+                    img_buf.seek(0)
+                    img_buf.truncate(0)
+                    img_buf.write(img_data)
+                    img_buf.seek(0)
+                    img_reader = ImageReader(img_buf)
 
                     margem_direita = 1.5 * cm
                     margem_inferior = 0.1 * cm
                     img_width = width - margem_direita
-                    img_height = height - margem_inferior - table.wrap(0, width)[1] - 2 * cm
+                    img_height = height - margem_inferior - table_height - 2 * cm
 
                     c.drawImage(img_reader, 0, height - img_height, width=img_width, height=img_height, preserveAspectRatio=True, anchor='nw')
-                    print(f"[GERAÇÃO] Imagem adicionada com sucesso para DANFE {i+1}")
+                    logger.debug("[GERAÇÃO] Imagem adicionada com sucesso para DANFE %d", i + 1)
                 except Exception as e:
-                    print(f"[GERAÇÃO] ERRO ao processar imagem para DANFE {i+1}: {str(e)}")
+                    logger.warning("[GERAÇÃO] ERRO ao processar imagem para DANFE %d: %s", i + 1, e)
                     img_height = 0
-            else:
-                print(f"[GERAÇÃO] Nenhuma imagem encontrada para DANFE {i+1}")
 
             # Posicionar tabela
             try:
                 if len(table_data) > 4:
                     c.showPage()
-                    table.wrapOn(c, width, height)
-                    table_y = height - table.wrap(0, width)[1] - 1 * cm
+                    table_y = height - table_height - 1 * cm
                     table.drawOn(c, 0.1 * cm, table_y)
                 else:
-                    table.wrapOn(c, width, height)
-                    table_y = height - img_height - table.wrap(0, width)[1] - 1 * cm
+                    table_y = height - img_height - table_height - 1 * cm
                     table.drawOn(c, 0.1 * cm, table_y)
                     
-                print(f"[GERAÇÃO] Tabela posicionada com sucesso para DANFE {i+1}")
+                logger.debug("[GERAÇÃO] Tabela posicionada com sucesso para DANFE %d", i + 1)
             except Exception as e:
-                print(f"[GERAÇÃO] ERRO ao posicionar tabela para DANFE {i+1}: {str(e)}")
-                continue
+                logger.warning("[GERAÇÃO] ERRO ao posicionar tabela para DANFE %d: %s", i + 1, e)
+                return
 
             # Adicionar contador de páginas (P1, P2, P3, etc.)
             try:
                 contador_texto = f"P{paginas_geradas + 1}"
-                c.setFont("Helvetica-Bold", 14)
-                c.setFillColor(colors.black)
                 # Posicionar no final da página, canto inferior direito
                 contador_x = width - 2 * cm
                 contador_y = 0.3 * cm  # Bem próximo à borda inferior
-                c.drawString(contador_x, contador_y, contador_texto)
-                print(f"[GERAÇÃO] Contador de página adicionado: {contador_texto}")
+                # Um único objeto de texto emite fonte e glifos juntos no
+                # mesmo bloco BT..ET, sem a ressincronização de estado e a
+                # consulta de métricas que drawString faz a cada chamada. O
+                # fill preto é o padrão do canvas e não é alterado em lugar
+                # nenhum, então não há setFillColor por página.
+                t = c.beginText(contador_x, contador_y)
+                t.setFont("Helvetica-Bold", 14)
+                t.textLine(contador_texto)
+                c.drawText(t)
+                logger.debug("[GERAÇÃO] Contador de página adicionado: %s", contador_texto)
             except Exception as e:
-                print(f"[GERAÇÃO] ERRO ao adicionar contador de página para DANFE {i+1}: {str(e)}")
+                logger.warning("[GERAÇÃO] ERRO ao adicionar contador de página para DANFE %d: %s", i + 1, e)
 
             c.showPage()
             paginas_geradas += 1
-            print(f"[GERAÇÃO] DANFE {i+1} concluída com sucesso")
+            logger.debug("[GERAÇÃO] DANFE %d concluída com sucesso", i + 1)
             
         except Exception as e:
-            print(f"[GERAÇÃO] ERRO INESPERADO ao processar DANFE {i+1}: {str(e)}")
-            continue
+            logger.warning("[GERAÇÃO] ERRO INESPERADO ao processar DANFE %d: %s", i + 1, e)
+
+    # Preparação em paralelo por DANFE (imagem + tabela são independentes);
+    # ex.map preserva a ordem de entrada, então o desenho serial abaixo sai na
+    # mesma ordem dos dados — e já sobrepõe desenho com preparação das próximas
+    tasks = list(enumerate(data))
+    n_workers = min(os.cpu_count() or 1, len(tasks))
+    if n_workers > 1:
+        with ProcessPoolExecutor(
+            max_workers=n_workers,
+            initializer=_prep_worker_init,
+            initargs=(input_pdf,),
+        ) as executor:
+            for prep in executor.map(_prepare_danfe, tasks):
+                desenhar_danfe(prep)
+    else:
+        # Uma DANFE só (ou um núcleo só): o pool não se paga. Documento e
+        # cache ficam locais da requisição — threads concorrentes do Flask
+        # não podem disputar estado de módulo
+        doc = _open_pdf(input_pdf)
+        try:
+            page_info = {}
+            for task in tasks:
+                desenhar_danfe(_prepare_danfe_impl(doc, page_info, task))
+        finally:
+            doc.close()
 
     # Finalizar PDF
     if paginas_geradas > 0:
         c.save()
-        print(f"[GERAÇÃO] PDF salvo com sucesso: {paginas_geradas} páginas geradas")
+        logger.info("[GERAÇÃO] PDF gerado com sucesso: %d páginas geradas", paginas_geradas)
     else:
-        print("[GERAÇÃO] ERRO: Nenhuma página foi gerada com sucesso")
+        logger.warning("[GERAÇÃO] ERRO: Nenhuma página foi gerada com sucesso")
         return False
         
-    doc.close()
     fim = time.time()
-    print(f"[GERAÇÃO] Concluída em {fim - inicio:.2f}s - {paginas_geradas}/{len(data)} DANFEs processadas")
-    return True
+    logger.info("[GERAÇÃO] Concluída em %.2fs - %d/%d DANFEs processadas", fim - inicio, paginas_geradas, len(data))
+    return out_buf.getvalue()
 
 if __name__ == '__main__':
-    # Registrar limpeza de arquivos temporários quando o servidor for encerrado
-    atexit.register(cleanup_temp_files)
+    logging.basicConfig(level=logging.DEBUG if DEBUG else logging.INFO)
     app.run(debug=True, port=5000)
\ No newline at end of file